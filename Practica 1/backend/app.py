@@ -1,32 +1,63 @@
 import os
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify
+
+# Servidor de desarrollo con GEVENT=1: parchear la librería estándar y psycopg2
+# antes de importarlos (con gunicorn lo hace gunicorn.conf.py)
+if os.environ.get("GEVENT") == "1":
+    from gevent import monkey
+
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+from flask import (
+    Flask,
+    Response,
+    request,
+    render_template,
+    redirect,
+    url_for,
+    session,
+    jsonify,
+    g,
+)
+import orjson
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import hashlib
-from datetime import datetime
-from functools import wraps
+import hmac
+import jinja2
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from functools import lru_cache
 
 # Configuración de la base de datos
 # Detectar si estamos en Docker o ejecutando localmente
 
 
+@lru_cache(maxsize=None)
 def get_db_host():
-    """Detecta el host de la base de datos según el entorno"""
-    db_host = os.environ.get("DB_HOST", "bd")
-    # Si DB_HOST no está definido o es 'bd', intentar localhost para tests locales
-    if db_host == "bd":
-        try:
-            # Intentar conectar a localhost:5432 primero (para tests locales)
-            import socket
-
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(1)
-            result = sock.connect_ex(("localhost", 5432))
-            sock.close()
-            if result == 0:
-                return "localhost"
-        except Exception:
-            pass
-    return db_host
+    """Detecta el host de la base de datos según el entorno (una sola vez)"""
+    db_host = os.environ.get("DB_HOST")
+    if db_host:
+        return db_host
+    # Sin DB_HOST, si Postgres está en la misma máquina conectar por socket UNIX
+    # (psycopg2 interpreta una ruta como directorio del socket), evitando TCP
+    puerto = int(os.environ.get("DB_PORT", 5432))
+    socket_dir = os.environ.get("DB_SOCKET_DIR", "/var/run/postgresql")
+    if os.path.exists(os.path.join(socket_dir, f".s.PGSQL.{puerto}")):
+        return socket_dir
+    # Si no, intentar localhost (para tests locales) y si no 'bd'
+    try:
+        socket.create_connection(("localhost", puerto), timeout=0.1).close()
+        return "localhost"
+    except OSError:
+        return "bd"
 
 
 DB_CONFIG = {
@@ -37,6 +68,12 @@ DB_CONFIG = {
     "port": int(os.environ.get("DB_PORT", 5432)),
 }
 
+# Tamaño del pool de conexiones (por proceso) y segundos que una petición espera
+# a que quede una conexión libre cuando están todas en uso
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FRONTEND_DIR = os.path.join(BASE_DIR, "frontend")
 
@@ -47,209 +84,641 @@ app = Flask(
 )
 app.secret_key = "postgres"
 
+# Las plantillas compiladas se guardan en disco para que los workers y los
+# reinicios no tengan que volver a analizarlas. Sin JINJA_CACHE_DIR, Jinja usa un
+# directorio temporal propio del usuario (0700) y comprueba su propietario; si se
+# indica uno, debe pertenecer a la aplicación (el bytecode se carga con marshal)
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(
+    os.environ.get("JINJA_CACHE_DIR")
+)
+
+# Compilar las plantillas al importar (con preload_app de gunicorn los workers
+# las heredan ya cargadas)
+for plantilla in (
+    "index.html",
+    "dashboard.html",
+    "historial_paciente.html",
+    "confirmar_eliminacion.html",
+):
+    app.jinja_env.get_template(plantilla)
+
+
+# Consultas frecuentes: cada conexión del pool las prepara (PREPARE) una sola vez
+# para que Postgres no tenga que volver a analizarlas y planificarlas
+CONSULTAS_PREPARADAS = {
+    "medico_login": (
+        "SELECT id, nombre, email, password_hash FROM medicos WHERE email = %s"
+    ),
+    "medico_por_id": "SELECT id, nombre FROM medicos WHERE id = %s",
+    "citas_medico": """
+        SELECT fecha, hora, motivo, id FROM citas
+        WHERE medico_id = %s
+        ORDER BY fecha, hora
+    """,
+    # Se cuenta c.paciente_id (columna de citas_medico_paciente_idx) y no c.id
+    # para que Postgres pueda contar las citas con un index-only scan
+    "pacientes_medico": """
+        SELECT p.id, p.nombre, p.edad, p.email, p.telefono, p.historial,
+               p.fecha_registro, COUNT(c.paciente_id) AS citas_count
+        FROM pacientes p
+        LEFT JOIN citas c
+            ON c.paciente_id = p.id AND c.medico_id = p.medico_id
+        WHERE p.medico_id = %s
+        GROUP BY p.id
+        ORDER BY p.nombre
+    """,
+    "paciente_por_id": """
+        SELECT p.id, p.nombre, p.edad, p.email, p.telefono, p.historial,
+               p.fecha_registro, COUNT(c.paciente_id) AS citas_count
+        FROM pacientes p
+        LEFT JOIN citas c
+            ON c.paciente_id = p.id AND c.medico_id = p.medico_id
+        WHERE p.medico_id = %s AND p.id = %s
+        GROUP BY p.id
+    """,
+    "cancelar_cita": """
+        UPDATE citas
+        SET cancelada = TRUE
+        WHERE id = %s AND medico_id = %s
+    """,
+    "historial_paciente": """
+        SELECT p.id, p.nombre, p.edad, p.email, p.telefono, p.historial,
+               p.fecha_registro,
+               c.id AS cita_id, c.medico_id, c.fecha, c.hora, c.motivo,
+               c.cancelada,
+               COUNT(c.id) FILTER (WHERE c.cancelada IS NOT TRUE) OVER ()
+                   AS citas_activas,
+               COUNT(c.id) FILTER (WHERE c.cancelada) OVER ()
+                   AS citas_canceladas
+        FROM pacientes p
+        LEFT JOIN citas c
+            ON c.paciente_id = p.id AND c.medico_id = p.medico_id
+        WHERE p.id = %s AND p.medico_id = %s
+        ORDER BY c.fecha DESC, c.hora DESC
+    """,
+    "eliminar_paciente": """
+        DELETE FROM pacientes
+        WHERE id = %s AND medico_id = %s
+        RETURNING nombre
+    """,
+    "paciente_confirmacion": """
+        SELECT p.id, p.nombre, p.edad, p.email, p.telefono, p.historial,
+               p.fecha_registro,
+               (SELECT COUNT(*) FROM citas c
+                WHERE c.paciente_id = p.id AND c.medico_id = p.medico_id)
+                   AS total_citas
+        FROM pacientes p
+        WHERE p.id = %s AND p.medico_id = %s
+    """,
+    # Inserta la cita solo si el paciente es del médico y no está duplicada;
+    # devuelve (paciente_existe, id_cita_nueva) en un único viaje a la BD
+    "insertar_cita": """
+        WITH datos (medico_id, paciente_id, fecha, hora, motivo) AS (
+            VALUES (%s::int, %s::int, %s::date, %s::time, %s::text)
+        ), paciente AS (
+            SELECT p.id FROM pacientes p, datos d
+            WHERE p.id = d.paciente_id AND p.medico_id = d.medico_id
+        ), nueva AS (
+            INSERT INTO citas (medico_id, paciente_id, fecha, hora, motivo)
+            SELECT d.medico_id, d.paciente_id, d.fecha, d.hora, d.motivo
+            FROM datos d
+            WHERE EXISTS (SELECT 1 FROM paciente)
+            ON CONFLICT (medico_id, paciente_id, fecha, hora, motivo) DO NOTHING
+            RETURNING id
+        )
+        SELECT EXISTS (SELECT 1 FROM paciente), (SELECT id FROM nueva)
+    """,
+}
+
+
+class ConexionBD(psycopg2.extensions.connection):
+    """Conexión que recuerda si ya tiene preparadas las consultas frecuentes"""
+
+    sentencias_preparadas = False
+
+
+def _a_parametros_posicionales(consulta):
+    """Convierte los marcadores %s de psycopg2 en $1, $2, ... para PREPARE"""
+    partes = consulta.split("%s")
+    sql = partes[0]
+    for i, parte in enumerate(partes[1:], start=1):
+        sql += f"${i}{parte}"
+    return sql
+
+
+def preparar_sentencias(conn):
+    """Prepara en la conexión todas las consultas de CONSULTAS_PREPARADAS"""
+    sql = "DEALLOCATE ALL;" + "".join(
+        f"PREPARE {nombre} AS {_a_parametros_posicionales(consulta)};"
+        for nombre, consulta in CONSULTAS_PREPARADAS.items()
+    )
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        cursor.close()
+        conn.sentencias_preparadas = True
+    except psycopg2.Error as e:
+        # Por ejemplo si las tablas aún no existen: se reintenta en el siguiente uso
+        print(f"No se pudieron preparar las consultas: {e}")
+
+
+def ejecutar_preparada(cursor, nombre, params):
+    """Ejecuta una consulta frecuente con EXECUTE si la conexión la tiene preparada"""
+    if getattr(cursor.connection, "sentencias_preparadas", False) is True:
+        marcadores = ", ".join(["%s"] * len(params))
+        cursor.execute(f"EXECUTE {nombre} ({marcadores})", params)
+    else:
+        cursor.execute(CONSULTAS_PREPARADAS[nombre], params)
+
+
+class PoolConEspera(psycopg2.pool.ThreadedConnectionPool):
+    """Pool que, si todas las conexiones están en uso, espera a que se libere una
+    en lugar de fallar inmediatamente con PoolError"""
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self._libres = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self._libres.acquire(timeout=DB_POOL_TIMEOUT):
+            raise psycopg2.pool.PoolError("no hay conexiones libres en el pool")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._libres.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._libres.release()
+
+    def _putconn(self, conn, key=None, close=False):
+        # psycopg2 cierra la conexión devuelta si ya hay minconn libres; aquí se
+        # guardan hasta maxconn para no volver a conectar y preparar las consultas
+        # en cada petición concurrente (las cerradas o rotas se descartan igual)
+        if self.closed:
+            raise psycopg2.pool.PoolError("connection pool is closed")
+        if key is None:
+            key = self._rused.get(id(conn))
+            if key is None:
+                raise psycopg2.pool.PoolError("trying to put unkeyed connection")
+
+        if len(self._pool) < self.maxconn and not close and not conn.closed:
+            estado = conn.info.transaction_status
+            if estado == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                # Se ha perdido la conexión con el servidor
+                conn.close()
+            else:
+                if estado != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self._pool.append(conn)
+        elif not conn.closed:
+            conn.close()
+
+        if not self.closed or key in self._used:
+            del self._used[key]
+            del self._rused[id(conn)]
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """Devuelve el pool de conexiones, creándolo la primera vez que se usa"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            # Se crea de forma perezosa para no conectar al importar el módulo
+            # (tests, o workers de gunicorn que aún no han hecho fork)
+            if _db_pool is None:
+                _db_pool = PoolConEspera(
+                    DB_POOL_MIN, DB_POOL_MAX, connection_factory=ConexionBD, **DB_CONFIG
+                )
+    return _db_pool
+
 
 def get_db_connection():
-    """Establece conexión con la base de datos"""
+    """Obtiene una conexión del pool de la base de datos"""
+    try:
+        pool = get_db_pool()
+        conn = pool.getconn()
+    except psycopg2.Error as e:
+        print(f"Error conectando a la base de datos: {e}")
+        return str(e)
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        conn.set_session(
-            autocommit=True, isolation_level="READ COMMITTED"
-        )  # Fuerza autocommit y aislamiento seguro
+        conn.autocommit = True  # Fuerza autocommit al sacar la conexión del pool
+        if not conn.sentencias_preparadas:
+            preparar_sentencias(conn)
         return conn
     except psycopg2.Error as e:
+        # Descartar la conexión para no dejarla ocupada en el pool
+        pool.putconn(conn, close=True)
         print(f"Error conectando a la base de datos: {e}")
         return str(e)
 
 
-def init_db():
-    """Inicializa la tabla pacientes si no existe y la tabla citas"""
+def release_db_connection(conn):
+    """Devuelve la conexión al pool en lugar de cerrarla"""
+    if _db_pool is not None:
+        _db_pool.putconn(conn)
+    else:
+        conn.close()
+
+
+class ErrorConexionBD(Exception):
+    """No se ha podido obtener una conexión a la base de datos"""
+
+
+@contextmanager
+def db_cursor(cursor_factory=None, transaccion=False):
+    """Cursor sobre una conexión del pool: hace commit (o rollback) y la devuelve
+
+    Con transaccion las sentencias se confirman juntas al final en lugar de una a
+    una.
+    """
     conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
-        print(f"Error inicializando la base de datos: {conn}")
-        return
+    if conn is None or isinstance(conn, str):
+        # get_db_connection devuelve el mensaje de error si no hay conexión
+        raise ErrorConexionBD(conn)
+    if transaccion:
+        # El autocommit se vuelve a activar al sacar la conexión del pool
+        conn.autocommit = False
+    cursor = conn.cursor(cursor_factory=cursor_factory)
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS medicos (
-                id SERIAL PRIMARY KEY,
-                nombre VARCHAR(255) NOT NULL,
-                email VARCHAR(255) UNIQUE NOT NULL,
-                password_hash VARCHAR(255) NOT NULL,
-                especialidad VARCHAR(255),
-                fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS pacientes (
-                id SERIAL PRIMARY KEY,
-                medico_id INT REFERENCES medicos(id) ON DELETE CASCADE,
-                nombre VARCHAR(255) NOT NULL,
-                edad INTEGER,
-                email VARCHAR(255),
-                telefono VARCHAR(50),
-                fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS citas (
-                id SERIAL PRIMARY KEY,
-                paciente_id INT REFERENCES pacientes(id) ON DELETE CASCADE,
-                medico_id INT REFERENCES medicos(id) ON DELETE CASCADE,
-                fecha DATE NOT NULL,
-                hora TIME NOT NULL,
-                motivo TEXT,
-                cancelada BOOLEAN DEFAULT FALSE
-            );
-        """
-        )
+        yield cursor
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cursor.close()
-        conn.close()
-    except psycopg2.Error as e:
+        release_db_connection(conn)
+
+
+# Esquema completo (tablas e índices) para crearlo en un único viaje a la BD
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS medicos (
+    id SERIAL PRIMARY KEY,
+    nombre VARCHAR(255) NOT NULL,
+    email VARCHAR(255) UNIQUE NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    especialidad VARCHAR(255),
+    fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS pacientes (
+    id SERIAL PRIMARY KEY,
+    medico_id INT REFERENCES medicos(id) ON DELETE CASCADE,
+    nombre VARCHAR(255) NOT NULL,
+    edad INTEGER,
+    email VARCHAR(255),
+    telefono VARCHAR(50),
+    historial TEXT,
+    fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS citas (
+    id SERIAL PRIMARY KEY,
+    paciente_id INT REFERENCES pacientes(id) ON DELETE CASCADE,
+    medico_id INT REFERENCES medicos(id) ON DELETE CASCADE,
+    fecha DATE NOT NULL,
+    hora TIME NOT NULL,
+    motivo TEXT,
+    cancelada BOOLEAN DEFAULT FALSE
+);
+
+-- Índices para los filtros por médico que usan todas las consultas y unicidad
+-- de citas (detecta duplicados con ON CONFLICT)
+CREATE INDEX IF NOT EXISTS pacientes_medico_idx ON pacientes(medico_id);
+CREATE INDEX IF NOT EXISTS citas_medico_paciente_idx ON citas(medico_id, paciente_id);
+CREATE INDEX IF NOT EXISTS citas_medico_fecha_hora_idx ON citas(medico_id, fecha, hora);
+CREATE UNIQUE INDEX IF NOT EXISTS citas_unique_slot
+    ON citas(medico_id, paciente_id, fecha, hora, motivo);
+"""
+
+
+def init_db():
+    """Inicializa las tablas medicos, pacientes y citas y sus índices si no existen"""
+    try:
+        with db_cursor() as cursor:
+            cursor.execute(SCHEMA_SQL)
+    except (ErrorConexionBD, psycopg2.Error) as e:
         print(f"Error inicializando la base de datos: {e}")
 
 
+def ensure_schema():
+    """Ejecuta init_db solo si falta alguna tabla o índice (una única consulta al
+    catálogo)"""
+    try:
+        with db_cursor() as cursor:
+            # Se comprueban también los índices: bases de datos creadas antes de
+            # añadirlos los necesitan (p. ej. ON CONFLICT usa citas_unique_slot)
+            cursor.execute(
+                """
+                SELECT to_regclass('public.medicos') IS NOT NULL
+                   AND to_regclass('public.pacientes') IS NOT NULL
+                   AND to_regclass('public.citas') IS NOT NULL
+                   AND to_regclass('public.pacientes_medico_idx') IS NOT NULL
+                   AND to_regclass('public.citas_medico_paciente_idx') IS NOT NULL
+                   AND to_regclass('public.citas_medico_fecha_hora_idx') IS NOT NULL
+                   AND to_regclass('public.citas_unique_slot') IS NOT NULL
+            """
+            )
+            esquema_creado = cursor.fetchone()[0]
+    except (ErrorConexionBD, psycopg2.Error) as e:
+        print(f"Error comprobando el esquema de la base de datos: {e}")
+        return
+
+    if not esquema_creado:
+        init_db()
+
+
+def cerrar_db_pool():
+    """Cierra todas las conexiones del pool (p. ej. antes de que gunicorn haga fork)"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea las tablas y los índices de la base de datos: flask --app app init-db"""
+    init_db()
+    cerrar_db_pool()
+
+
 # FUNCIONES AUXILIARES
 
 
+class CacheTTL:
+    """Caché en memoria con caducidad por entrada y tamaño máximo (LRU)"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return default
+            valor, expira = entrada
+            if expira < time.monotonic():
+                del self._datos[clave]
+                return default
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.maxsize:
+                self._datos.popitem(last=False)
+
+    def delete(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+
+
+# (id, nombre) de los médicos ya verificados, para no consultar la BD en cada petición
+_medicos_cache = CacheTTL(maxsize=10_000, ttl=60)
+
+# Respuesta JSON de /api/citas (cuerpo y ETag) por médico; se invalida al crear,
+# cancelar o eliminar citas
+_citas_cache = CacheTTL(maxsize=10_000, ttl=30)
+
+
+# Lista de pacientes del dashboard por médico; se invalida al añadir o eliminar
+# pacientes (el dashboard no muestra citas_count, así que crear citas no la cambia)
+_pacientes_cache = CacheTTL(maxsize=10_000, ttl=30)
+
+
+# Páginas de confirmación ya renderizadas. La clave es un blake2b de los datos que
+# muestra la plantilla, así que si cambian se genera otra clave y no hace falta
+# invalidar nada
+_paginas_cache = CacheTTL(maxsize=512, ttl=300)
+
+
+# Las cachés son de cada worker, así que la clave lleva una versión guardada en la
+# sesión: se renueva al entrar y al escribir, y cualquier worker que reciba la
+# siguiente petición de esa sesión deja de encontrar la entrada antigua (la cookie
+# viaja con ella). Otras sesiones abiertas del mismo médico no conocen la nueva
+# versión y pueden ver datos de hasta un TTL (30 s) de antigüedad
+def clave_cache(medico_id, version):
+    """Clave de caché del médico para la versión de sus datos en la sesión"""
+    return medico_id, session.get(version, 0)
+
+
+def invalidar_citas(medico_id):
+    """Descarta la respuesta de /api/citas guardada para el médico"""
+    _citas_cache.delete(clave_cache(medico_id, "version_citas"))
+    session["version_citas"] = time.time_ns()
+
+
+def invalidar_pacientes(medico_id):
+    """Descarta la lista de pacientes del dashboard guardada para el médico"""
+    _pacientes_cache.delete(clave_cache(medico_id, "version_pacientes"))
+    session["version_pacientes"] = time.time_ns()
+
+
+# Parámetros de scrypt para las contraseñas (n=2**14, r=8 → 16 MB por hash)
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# Hash scrypt que no corresponde a ninguna contraseña: el login lo verifica cuando
+# el email no existe para que tarde lo mismo y no revele qué emails están dados
+# de alta
+_HASH_FICTICIO = f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${'0' * 32}${'0' * 64}"
+
+# Logins ya verificados: evita repetir scrypt en logins sucesivos del mismo médico.
+# Las claves usan un blake2b con clave aleatoria del proceso, nunca la contraseña.
+_logins_verificados = CacheTTL(maxsize=4096, ttl=300)
+_CLAVE_LOGINS = os.urandom(32)
+
+
 def hash_password(password):
-    """Genera hash de la contraseña"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Genera hash scrypt de la contraseña con sal aleatoria"""
+    salt = os.urandom(16)
+    derivada = hashlib.scrypt(
+        password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32
+    )
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${derivada.hex()}"
 
 
-def get_next_medico_id():
-    """Obtiene el siguiente ID disponible para médicos"""
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM medicos")
-            next_id = cursor.fetchone()[0]
-            cursor.close()
-            conn.close()
-            return next_id
-        except psycopg2.Error as e:
-            print(f"Error obteniendo siguiente ID: {e}")
-            return 1
-    return 1
+def verificar_password(password, password_hash):
+    """Comprueba una contraseña contra el hash guardado en la base de datos"""
+    clave = (
+        password_hash,
+        hashlib.blake2b(password.encode(), key=_CLAVE_LOGINS).digest(),
+    )
+    if _logins_verificados.get(clave):
+        return True
+
+    if password_hash.startswith("scrypt$"):
+        _, n, r, p, salt, esperado = password_hash.split("$")
+        derivada = hashlib.scrypt(
+            password.encode(),
+            salt=bytes.fromhex(salt),
+            n=int(n),
+            r=int(r),
+            p=int(p),
+            dklen=len(esperado) // 2,
+        )
+        valida = hmac.compare_digest(derivada.hex(), esperado)
+    else:
+        # Hash SHA-256 sin sal de los médicos registrados antes de usar scrypt
+        valida = hmac.compare_digest(
+            hashlib.sha256(password.encode()).hexdigest(), password_hash
+        )
 
+    if valida:
+        _logins_verificados.set(clave, True)
+    return valida
 
-def login_required(f):
-    """Decorador que requiere que el médico esté autenticado"""
 
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if "medico_id" not in session:
-            return redirect(url_for("index"))
+def actualizar_hash_password(medico_id, password):
+    """Sustituye un hash SHA-256 antiguo por uno scrypt tras un login correcto"""
+    try:
+        with db_cursor() as cursor:
+            cursor.execute(
+                "UPDATE medicos SET password_hash = %s WHERE id = %s",
+                (hash_password(password), medico_id),
+            )
+    except (ErrorConexionBD, psycopg2.Error) as e:
+        # No impide el login: se volverá a intentar en el siguiente
+        print(f"Error actualizando el hash de la contraseña: {e}")
 
-        # Verificar que el medico_id existe en la base de datos
-        conn = get_db_connection()
-        if isinstance(conn, psycopg2.extensions.connection):
-            try:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT id, nombre FROM medicos WHERE id = %s",
-                    (session["medico_id"],),
-                )
-                medico = cursor.fetchone()
-                cursor.close()
-                conn.close()
 
-                if not medico:
-                    # Médico no existe en BD, limpiar sesión
-                    session.clear()
-                    return redirect(url_for("index"))
+# Endpoints accesibles sin haber iniciado sesión
+ENDPOINTS_PUBLICOS = frozenset({"index", "login", "register", "logout", "static"})
 
-                # Actualizar nombre en sesión si existe
-                session["medico_nombre"] = medico[1]
 
-            except Exception as e:
-                session.clear()
-                return redirect(url_for("index"))
-        else:
-            # Error de conexión
+@app.before_request
+def autenticar_medico():
+    """Carga el médico de la sesión en g y exige sesión fuera de ENDPOINTS_PUBLICOS"""
+    g.medico_id = medico_id = session.get("medico_id")
+    g.medico_nombre = session.get("medico_nombre")
+
+    # Rutas públicas o inexistentes (404) no necesitan médico autenticado
+    if request.endpoint is None or request.endpoint in ENDPOINTS_PUBLICOS:
+        return None
+
+    if medico_id is None:
+        return redirect(url_for("index"))
+
+    medico = _medicos_cache.get(medico_id)
+    if medico is None:
+        # Verificar que el medico_id existe en la base de datos
+        try:
+            with db_cursor() as cursor:
+                ejecutar_preparada(cursor, "medico_por_id", (medico_id,))
+                medico = cursor.fetchone()
+        except ErrorConexionBD:
+            return redirect(url_for("index"))
+        except Exception:
+            session.clear()
+            return redirect(url_for("index"))
+
+        if not medico:
+            # Médico no existe en BD, limpiar sesión
+            session.clear()
             return redirect(url_for("index"))
 
-        return f(*args, **kwargs)
+        _medicos_cache.set(medico_id, (medico[0], medico[1]))
 
-    return decorated_function
+    # Actualizar el nombre solo si ha cambiado: escribir en la sesión obliga a
+    # volver a firmar y enviar la cookie en la respuesta
+    g.medico_nombre = medico[1]
+    if session.get("medico_nombre") != medico[1]:
+        session["medico_nombre"] = medico[1]
+    return None
 
 
 def obtener_citas_medico(medico_id):
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
-        return [], f"Error conexión obtener_citas_medico: {conn}"
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT fecha, hora, motivo, id FROM citas WHERE medico_id = %s ORDER BY fecha, hora",
-            (medico_id,),
-        )
-        citas = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return citas, None
+        with db_cursor() as cursor:
+            ejecutar_preparada(cursor, "citas_medico", (medico_id,))
+            return cursor.fetchall(), None
+    except ErrorConexionBD as e:
+        return [], f"Error conexión obtener_citas_medico: {e}"
     except Exception as e:
         return [], f"Error en obtener_citas_medico: {e}"
 
 
 def obtener_pacientes_medico(medico_id):
-    conn = get_db_connection()
-    if not conn:
+    try:
+        with db_cursor(psycopg2.extras.RealDictCursor) as cursor:
+            # TODOS los pacientes del médico (no solo los que tienen citas) junto
+            # con su número de citas, en una sola consulta
+            ejecutar_preparada(cursor, "pacientes_medico", (medico_id,))
+            return cursor.fetchall(), None
+    except ErrorConexionBD:
         return [], "Error de conexión a la base de datos"
+    except Exception as e:
+        return [], str(e)
+
 
+def insertar_pacientes(medico_id, pacientes):
+    """Inserta varios pacientes del médico en una sola sentencia y devuelve sus IDs
+
+    Cada paciente es una tupla (nombre, edad, email, telefono, fecha_registro,
+    historial).
+    """
+    filas = [(medico_id, *paciente) for paciente in pacientes]
+    if not filas:
+        return [], None
     try:
-        cursor = conn.cursor()
-        # Cambiar consulta para obtener TODOS los pacientes del médico, no solo los que tienen citas
-        cursor.execute(
-            """
-            SELECT id, nombre, edad, email, telefono, historial, fecha_registro 
-            FROM pacientes
-            WHERE medico_id = %s
-            ORDER BY nombre;
-        """,
-            (medico_id,),
-        )
-        pacientes = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return pacientes, None
+        # execute_values manda una sentencia por página: en una transacción para
+        # que un error a mitad no deje insertada solo una parte de los pacientes
+        with db_cursor(transaccion=True) as cursor:
+            ids = psycopg2.extras.execute_values(
+                cursor,
+                """
+                INSERT INTO pacientes (medico_id, nombre, edad, email, telefono,
+                                       fecha_registro, historial)
+                VALUES %s
+                RETURNING id
+            """,
+                filas,
+                page_size=500,
+                fetch=True,
+            )
+        return [fila[0] for fila in ids], None
+    except ErrorConexionBD:
+        return [], "Error de conexión a la base de datos"
     except Exception as e:
         return [], str(e)
 
 
 def buscar_paciente_por_id(medico_id, paciente_id):
     """Busca un paciente específico por ID que pertenezca al médico"""
-    conn = get_db_connection()
-    if not conn:
-        return [], "Error de conexión a la base de datos"
-
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT id, nombre, edad, email, telefono, historial, fecha_registro 
-            FROM pacientes
-            WHERE medico_id = %s AND id = %s
-        """,
-            (medico_id, paciente_id),
-        )
-        paciente = cursor.fetchone()
-        cursor.close()
-        conn.close()
-
-        if paciente:
-            return [paciente], None
-        else:
-            return [], "Paciente no encontrado"
+        with db_cursor(psycopg2.extras.RealDictCursor) as cursor:
+            ejecutar_preparada(cursor, "paciente_por_id", (medico_id, paciente_id))
+            paciente = cursor.fetchone()
+    except ErrorConexionBD:
+        return [], "Error de conexión a la base de datos"
     except Exception as e:
         return [], str(e)
 
+    if paciente:
+        return [paciente], None
+    else:
+        return [], "Paciente no encontrado"
+
 
 # RUTAS DE LA APLICACIÓN
 
@@ -280,39 +749,17 @@ def login():
             show_register=False,
         )
 
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
+    try:
+        with db_cursor() as cursor:
+            ejecutar_preparada(cursor, "medico_login", (email,))
+            medico = cursor.fetchone()
+    except ErrorConexionBD as e:
         return render_template(
             "index.html",
-            message=f"Error de conexión a la base de datos: {conn}",
+            message=f"Error de conexión a la base de datos: {e}",
             success=False,
             show_register=False,
         )
-
-    try:
-        cursor = conn.cursor()
-        password_hash = hash_password(password)
-        cursor.execute(
-            "SELECT id, nombre, email FROM medicos WHERE email = %s AND password_hash = %s",
-            (email, password_hash),
-        )
-        medico = cursor.fetchone()
-        cursor.close()
-        conn.close()
-
-        if medico:
-            # Login exitoso
-            session["medico_id"] = medico[0]
-            session["medico_nombre"] = medico[1]
-            session["medico_email"] = medico[2]
-            return redirect(url_for("dashboard"))
-        else:
-            return render_template(
-                "index.html",
-                message="Credenciales incorrectas",
-                success=False,
-                show_register=False,
-            )
     except psycopg2.Error as e:
         return render_template(
             "index.html",
@@ -321,6 +768,26 @@ def login():
             show_register=False,
         )
 
+    password_hash = medico[3] if medico else _HASH_FICTICIO
+    if verificar_password(password, password_hash) and medico:
+        if not medico[3].startswith("scrypt$"):
+            actualizar_hash_password(medico[0], password)
+        # Login exitoso
+        session["medico_id"] = medico[0]
+        session["medico_nombre"] = medico[1]
+        session["medico_email"] = medico[2]
+        # Versiones nuevas para no reutilizar entradas de una sesión anterior
+        session["version_citas"] = session["version_pacientes"] = time.time_ns()
+        _medicos_cache.set(medico[0], (medico[0], medico[1]))
+        return redirect(url_for("dashboard"))
+    else:
+        return render_template(
+            "index.html",
+            message="Credenciales incorrectas",
+            success=False,
+            show_register=False,
+        )
+
 
 @app.route("/register", methods=["POST"])
 def register():
@@ -338,55 +805,52 @@ def register():
             show_register=True,
         )
 
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
+    password_hash = hash_password(password)
+    try:
+        with db_cursor() as cursor:
+            # Registrar nuevo médico (no inserta nada si el email ya existe)
+            cursor.execute(
+                """
+                INSERT INTO medicos (nombre, email, password_hash, especialidad)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (email) DO NOTHING
+                RETURNING id
+            """,
+                (nombre, email, password_hash, especialidad),
+            )
+            medico = cursor.fetchone()
+    except ErrorConexionBD as e:
         return render_template(
             "index.html",
-            message=f"Error de conexión a la base de datos: {conn}",
+            message=f"Error de conexión a la base de datos: {e}",
             success=False,
             show_register=True,
         )
-
-    try:
-        cursor = conn.cursor()
-        # Verificar si el email ya existe
-        cursor.execute("SELECT id FROM medicos WHERE email = %s", (email,))
-        if cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return render_template(
-                "index.html",
-                message="Este email ya está registrado",
-                success=False,
-                show_register=True,
-            )
-
-        # Registrar nuevo médico
-        password_hash = hash_password(password)
-        cursor.execute(
-            "INSERT INTO medicos (nombre, email, password_hash, especialidad) VALUES (%s, %s, %s, %s)",
-            (nombre, email, password_hash, especialidad),
-        )
-        cursor.close()
-        conn.close()
-
+    except psycopg2.Error as e:
         return render_template(
             "index.html",
-            message="Registro exitoso. Ahora puedes iniciar sesión.",
-            success=True,
-            show_register=False,
+            message=f"Error en el registro: {e}",
+            success=False,
+            show_register=True,
         )
-    except psycopg2.Error as e:
+
+    if not medico:
         return render_template(
             "index.html",
-            message=f"Error en el registro: {e}",
+            message="Este email ya está registrado",
             success=False,
             show_register=True,
         )
 
+    return render_template(
+        "index.html",
+        message="Registro exitoso. Ahora puedes iniciar sesión.",
+        success=True,
+        show_register=False,
+    )
+
 
 @app.route("/dashboard", methods=["GET", "POST"])
-@login_required
 def dashboard():
     """Dashboard del médico: ver pacientes, agregar pacientes y buscar por ID"""
     message = None
@@ -395,8 +859,8 @@ def dashboard():
     data_pacientes = []
 
     try:
-        medico_id = session.get("medico_id")
-        medico_nombre = session.get("medico_nombre")
+        medico_id = g.medico_id
+        medico_nombre = g.medico_nombre
 
         # Mensajes desde GET
         if request.method == "GET":
@@ -419,49 +883,16 @@ def dashboard():
                 pacientes = []
                 error_pacientes = "ID inválido"
         else:
-            # Obtener todos los pacientes del médico
-            pacientes, error_pacientes = obtener_pacientes_medico(medico_id)
+            # Obtener todos los pacientes del médico (de la caché si está)
+            clave = clave_cache(medico_id, "version_pacientes")
+            pacientes, error_pacientes = _pacientes_cache.get(clave), None
+            if pacientes is None:
+                pacientes, error_pacientes = obtener_pacientes_medico(medico_id)
+                if error_pacientes is None:
+                    _pacientes_cache.set(clave, pacientes)
 
-        for paciente in pacientes:
-            (
-                paciente_id,
-                nombre,
-                edad,
-                email,
-                telefono,
-                historial,
-                fecha_registro,
-            ) = paciente
-
-            # Obtener solo el conteo de citas para estadísticas básicas
-            conn = get_db_connection()
-            if not conn:
-                citas_count = 0
-            else:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    SELECT COUNT(*) FROM citas
-                    WHERE medico_id = %s AND paciente_id = %s
-                """,
-                    (medico_id, paciente_id),
-                )
-                citas_count = cursor.fetchone()[0]
-                cursor.close()
-                conn.close()
-
-            data_pacientes.append(
-                {
-                    "id": paciente_id,
-                    "nombre": nombre,
-                    "edad": edad,
-                    "email": email,
-                    "telefono": telefono,
-                    "historial": historial,
-                    "fecha_registro": fecha_registro,
-                    "citas_count": citas_count,
-                }
-            )
+        # Las filas ya son diccionarios (RealDictCursor) que usa la plantilla
+        data_pacientes = pacientes
 
     except Exception as e:
         error_dashboard = f"Error global en dashboard: {e}"
@@ -473,113 +904,148 @@ def dashboard():
         message=message,
         success=success,
         error_dashboard=error_dashboard,
-        fecha_hoy=datetime.now().strftime("%Y-%m-%d"),
+        fecha_hoy=date.today().isoformat(),
     )
 
 
 @app.route("/api/citas")
-@login_required
 def api_citas():
     """Devuelve las citas del usuario autenticado en formato JSON"""
-    user_id = session["medico_id"]
-    citas, error = obtener_citas_medico(user_id)
-
-    if error:
-        return jsonify({"error": error}), 500
+    user_id = g.medico_id
+    clave = clave_cache(user_id, "version_citas")
+    cacheado = _citas_cache.get(clave)
+    if cacheado is None:
+        citas, error = obtener_citas_medico(user_id)
+
+        if error:
+            return jsonify({"error": error}), 500
+
+        # orjson serializa date/time directamente en formato ISO
+        cuerpo = orjson.dumps(
+            [
+                {"fecha": cita[0], "hora": cita[1], "motivo": cita[2], "id": cita[3]}
+                for cita in citas
+            ],
+            default=str,
+        )
+        # ETag calculado una vez por respuesta cacheada (blake2b: no es un uso
+        # de seguridad y es más rápido que SHA-256)
+        etag = hashlib.blake2b(cuerpo, digest_size=16).hexdigest()
+        cacheado = (cuerpo, etag)
+        _citas_cache.set(clave, cacheado)
 
-    citas_json = [
-        {"fecha": str(cita[0]), "hora": str(cita[1]), "motivo": cita[2], "id": cita[3]}
-        for cita in citas
-    ]
-    return jsonify(citas_json)
+    cuerpo, etag = cacheado
+    respuesta = Response(cuerpo, mimetype="application/json")
+    respuesta.set_etag(etag)
+    # Si el cliente ya tiene esta versión se responde 304 sin cuerpo
+    return respuesta.make_conditional(request)
 
 
 @app.route("/cancelar_cita/<int:cita_id>", methods=["POST"])
-@login_required
 def cancelar_cita(cita_id):
     """Marca una cita como cancelada para el médico autenticado"""
-    medico_id = session["medico_id"]
+    medico_id = g.medico_id
 
     # Obtener parámetros de redirección
     redirect_to = request.form.get("redirect_to", "dashboard")
     paciente_id = request.form.get("paciente_id")
 
-    conn = get_db_connection()
+    try:
+        with db_cursor() as cursor:
+            # Solo permite cancelar citas del médico autenticado
+            ejecutar_preparada(cursor, "cancelar_cita", (cita_id, medico_id))
+        invalidar_citas(medico_id)
+        mensaje, exito = "Cita cancelada correctamente.", True
+    except ErrorConexionBD:
+        mensaje, exito = "Error de conexión a la base de datos.", False
+    except Exception as e:
+        mensaje, exito = f"Error al cancelar la cita: {e}", False
 
-    if not isinstance(conn, psycopg2.extensions.connection):
-        # Error de conexión
-        if redirect_to == "historial" and paciente_id:
-            return redirect(
-                url_for(
-                    "historial_paciente",
-                    paciente_id=paciente_id,
-                    mensaje="Error de conexión a la base de datos.",
-                    exito=False,
-                )
-            )
+    # Redirigir según el origen
+    if redirect_to == "historial" and paciente_id:
         return redirect(
             url_for(
-                "dashboard",
-                mensaje="Error de conexión a la base de datos.",
-                exito=False,
+                "historial_paciente",
+                paciente_id=paciente_id,
+                mensaje=mensaje,
+                exito=exito,
             )
         )
+    return redirect(url_for("dashboard", mensaje=mensaje, exito=exito))
 
-    try:
-        cursor = conn.cursor()
-        # Solo permite cancelar citas del médico autenticado
-        cursor.execute(
-            """
-            UPDATE citas
-            SET cancelada = TRUE
-            WHERE id = %s AND medico_id = %s
-        """,
-            (cita_id, medico_id),
+
+# Máximo de pacientes que se aceptan en una misma petición JSON
+MAX_PACIENTES_JSON = 1000
+
+
+def agregar_pacientes_json(medico_id):
+    """Inserta en una sola sentencia la lista de pacientes enviada como JSON"""
+    datos = request.get_json(silent=True)
+    if isinstance(datos, dict):
+        datos = [datos]
+    if not isinstance(datos, list) or not datos:
+        return jsonify({"error": "Se esperaba una lista de pacientes"}), 400
+    if len(datos) > MAX_PACIENTES_JSON:
+        return (
+            jsonify({"error": f"Máximo {MAX_PACIENTES_JSON} pacientes por petición"}),
+            400,
         )
-        conn.commit()
-        cursor.close()
-        conn.close()
 
-        # Redirigir según el origen
-        if redirect_to == "historial" and paciente_id:
-            return redirect(
-                url_for(
-                    "historial_paciente",
-                    paciente_id=paciente_id,
-                    mensaje="Cita cancelada correctamente.",
-                    exito=True,
-                )
+    obligatorios = ("nombre", "edad", "email", "fecha_registro")
+    textos = ("nombre", "email", "telefono", "fecha_registro", "historial")
+    pacientes = []
+    for i, paciente in enumerate(datos):
+        # Se comprueba None/"" y no la veracidad para admitir valores como edad 0
+        if not isinstance(paciente, dict) or any(
+            paciente.get(campo) in (None, "") for campo in obligatorios
+        ):
+            return (
+                jsonify({"error": f"Paciente {i}: faltan campos obligatorios"}),
+                400,
+            )
+        if any(
+            not isinstance(paciente.get(campo), (str, type(None))) for campo in textos
+        ):
+            return jsonify({"error": f"Paciente {i}: campos de texto inválidos"}), 400
+        # Solo enteros o texto con un entero: int() aceptaría también true o 3.7
+        edad = paciente["edad"]
+        try:
+            if isinstance(edad, str):
+                edad = int(edad)
+            elif not isinstance(edad, int) or isinstance(edad, bool):
+                raise ValueError
+        except ValueError:
+            return jsonify({"error": f"Paciente {i}: edad inválida"}), 400
+        try:
+            date.fromisoformat(paciente["fecha_registro"])
+        except ValueError:
+            return jsonify({"error": f"Paciente {i}: fecha_registro inválida"}), 400
+        pacientes.append(
+            (
+                paciente["nombre"],
+                edad,
+                paciente["email"],
+                paciente.get("telefono"),
+                paciente["fecha_registro"],
+                paciente.get("historial"),
             )
-        return redirect(
-            url_for("dashboard", mensaje="Cita cancelada correctamente.", exito=True)
         )
 
-    except Exception as e:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+    ids, error = insertar_pacientes(medico_id, pacientes)
+    if error:
+        return jsonify({"error": error}), 500
 
-        # Manejo de error con redirección apropiada
-        if redirect_to == "historial" and paciente_id:
-            return redirect(
-                url_for(
-                    "historial_paciente",
-                    paciente_id=paciente_id,
-                    mensaje=f"Error al cancelar la cita: {e}",
-                    exito=False,
-                )
-            )
-        return redirect(
-            url_for("dashboard", mensaje=f"Error al cancelar la cita: {e}", exito=False)
-        )
+    invalidar_pacientes(medico_id)
+    return jsonify({"ids": ids}), 201
 
 
 @app.route("/agregar_paciente", methods=["POST"])
-@login_required
 def agregar_paciente():
-    """Agrega un paciente para el médico actual"""
-    medico_id = session["medico_id"]
+    """Agrega un paciente para el médico actual (o varios si se envía JSON)"""
+    medico_id = g.medico_id
+
+    if request.is_json:
+        return agregar_pacientes_json(medico_id)
 
     nombre = request.form.get("nombre")
     edad = request.form.get("edad")
@@ -610,47 +1076,27 @@ def agregar_paciente():
             )
         )
 
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
+    try:
+        with db_cursor() as cursor:
+            # Insertar paciente con medico_id
+            cursor.execute(
+                """
+                INSERT INTO pacientes (medico_id, nombre, edad, email, telefono,
+                                       fecha_registro, historial)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+                (medico_id, nombre, edad, email, telefono, fecha_registro, historial),
+            )
+    except ErrorConexionBD as e:
         return redirect(
             url_for(
                 "dashboard",
-                mensaje=f"Error BD: {conn}",
+                mensaje=f"Error BD: {e}",
                 exito=False,
                 mostrar_formulario="true",
             )
         )
-
-    try:
-        cursor = conn.cursor()
-        # Insertar paciente con medico_id
-        cursor.execute(
-            """
-            INSERT INTO pacientes (medico_id, nombre, edad, email, telefono, fecha_registro, historial)
-            VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
-        """,
-            (medico_id, nombre, edad, email, telefono, fecha_registro, historial),
-        )
-        paciente_id = cursor.fetchone()[0]
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-        # Éxito: ocultar formulario
-        return redirect(
-            url_for(
-                "dashboard",
-                mensaje=f"Paciente '{nombre}' agregado correctamente.",
-                exito=True,
-            )
-        )
-
     except Exception as e:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
         # Error: mantener formulario visible
         return redirect(
             url_for(
@@ -661,36 +1107,34 @@ def agregar_paciente():
             )
         )
 
+    invalidar_pacientes(medico_id)
+
+    # Éxito: ocultar formulario
+    return redirect(
+        url_for(
+            "dashboard",
+            mensaje=f"Paciente '{nombre}' agregado correctamente.",
+            exito=True,
+        )
+    )
+
 
 @app.route("/historial/<int:paciente_id>")
-@login_required
 def historial_paciente(paciente_id):
     """Muestra el historial completo de un paciente específico"""
-    medico_id = session["medico_id"]
-    medico_nombre = session["medico_nombre"]
-
-    # Obtener información del paciente
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
-        return redirect(url_for("dashboard", mensaje=f"Error BD: {conn}", exito=False))
+    medico_id = g.medico_id
+    medico_nombre = g.medico_nombre
 
     try:
-        cursor = conn.cursor()
+        with db_cursor(psycopg2.extras.RealDictCursor) as cursor:
+            # Paciente (verificando que pertenece al médico), sus citas y las
+            # estadísticas en una sola consulta: una fila por cita, o una sola
+            # fila con las columnas de la cita a NULL si no tiene ninguna
+            ejecutar_preparada(cursor, "historial_paciente", (paciente_id, medico_id))
 
-        # Verificar que el paciente pertenece al médico
-        cursor.execute(
-            """
-            SELECT id, nombre, edad, email, telefono, historial, fecha_registro
-            FROM pacientes
-            WHERE id = %s AND medico_id = %s
-        """,
-            (paciente_id, medico_id),
-        )
+            filas = cursor.fetchall()
 
-        paciente_data = cursor.fetchone()
-        if not paciente_data:
-            cursor.close()
-            conn.close()
+        if not filas:
             return redirect(
                 url_for(
                     "dashboard",
@@ -699,36 +1143,14 @@ def historial_paciente(paciente_id):
                 )
             )
 
-        # Crear objeto paciente
-        paciente = {
-            "id": paciente_data[0],
-            "nombre": paciente_data[1],
-            "edad": paciente_data[2],
-            "email": paciente_data[3],
-            "telefono": paciente_data[4],
-            "historial": paciente_data[5],
-            "fecha_registro": paciente_data[6],
-        }
-
-        # Obtener todas las citas del paciente
-        cursor.execute(
-            """
-            SELECT id, medico_id, fecha, hora, motivo, cancelada
-            FROM citas
-            WHERE paciente_id = %s AND medico_id = %s
-            ORDER BY fecha DESC, hora DESC
-        """,
-            (paciente_id, medico_id),
-        )
-
-        citas = cursor.fetchall()
+        # Las filas de RealDictCursor se pasan tal cual a la plantilla: la primera
+        # sirve como paciente y las que tienen cita_id son las citas
+        paciente = filas[0]
+        citas = [fila for fila in filas if fila["cita_id"] is not None]
 
-        # Calcular estadísticas
-        citas_activas = sum(1 for cita in citas if not cita[5])
-        citas_canceladas = sum(1 for cita in citas if cita[5])
-
-        cursor.close()
-        conn.close()
+        # Estadísticas (iguales en todas las filas)
+        citas_activas = paciente["citas_activas"]
+        citas_canceladas = paciente["citas_canceladas"]
 
         # Obtener mensajes desde GET parameters
         message = request.args.get("mensaje")
@@ -743,16 +1165,14 @@ def historial_paciente(paciente_id):
             citas_activas=citas_activas,
             citas_canceladas=citas_canceladas,
             medico_nombre=medico_nombre,
-            fecha_hoy=datetime.now().strftime("%Y-%m-%d"),
+            fecha_hoy=date.today().isoformat(),
             message=message,
             success=success,
         )
 
+    except ErrorConexionBD as e:
+        return redirect(url_for("dashboard", mensaje=f"Error BD: {e}", exito=False))
     except Exception as e:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
         return redirect(
             url_for(
                 "dashboard", mensaje=f"Error al obtener historial: {e}", exito=False
@@ -761,10 +1181,9 @@ def historial_paciente(paciente_id):
 
 
 @app.route("/historial/<int:paciente_id>/agregar_cita", methods=["POST"])
-@login_required
 def agregar_cita_historial(paciente_id):
     """Agrega una nueva cita desde la vista de historial"""
-    medico_id = session["medico_id"]
+    medico_id = g.medico_id
 
     fecha = request.form.get("fecha")
     hora = request.form.get("hora")
@@ -781,98 +1200,66 @@ def agregar_cita_historial(paciente_id):
             )
         )
 
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
+    try:
+        with db_cursor() as cursor:
+            # Crear la cita verificando en la misma consulta que el paciente
+            # pertenece al médico y que no existe ya una cita con los mismos datos
+            ejecutar_preparada(
+                cursor, "insertar_cita", (medico_id, paciente_id, fecha, hora, motivo)
+            )
+            paciente_existe, cita_id = cursor.fetchone()
+    except ErrorConexionBD as e:
         return redirect(
             url_for(
                 "historial_paciente",
                 paciente_id=paciente_id,
-                mensaje=f"Error BD: {conn}",
+                mensaje=f"Error BD: {e}",
                 exito=False,
                 nueva_cita="true",
             )
         )
-
-    try:
-        cursor = conn.cursor()
-
-        # Verificar que el paciente pertenece al médico
-        cursor.execute(
-            "SELECT id FROM pacientes WHERE id = %s AND medico_id = %s",
-            (paciente_id, medico_id),
-        )
-        if not cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return redirect(
-                url_for("dashboard", mensaje="Paciente no encontrado.", exito=False)
-            )
-
-        # Verificar si ya existe una cita con los mismos datos
-        cursor.execute(
-            """
-            SELECT id FROM citas
-            WHERE medico_id = %s AND paciente_id = %s AND fecha = %s AND hora = %s AND motivo = %s
-        """,
-            (medico_id, paciente_id, fecha, hora, motivo),
-        )
-
-        if cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return redirect(
-                url_for(
-                    "historial_paciente",
-                    paciente_id=paciente_id,
-                    mensaje="Ya existe una cita con esos datos.",
-                    exito=False,
-                    nueva_cita="true",
-                )
-            )
-
-        # Crear la cita
-        cursor.execute(
-            """
-            INSERT INTO citas (medico_id, paciente_id, fecha, hora, motivo)
-            VALUES (%s, %s, %s, %s, %s)
-        """,
-            (medico_id, paciente_id, fecha, hora, motivo),
-        )
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-
+    except Exception as e:
         return redirect(
             url_for(
                 "historial_paciente",
                 paciente_id=paciente_id,
-                mensaje="Cita agendada correctamente.",
-                exito=True,
+                mensaje=f"Error al agendar cita: {e}",
+                exito=False,
+                nueva_cita="true",
             )
         )
 
-    except Exception as e:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+    if not paciente_existe:
+        return redirect(
+            url_for("dashboard", mensaje="Paciente no encontrado.", exito=False)
+        )
+
+    if cita_id is None:
         return redirect(
             url_for(
                 "historial_paciente",
                 paciente_id=paciente_id,
-                mensaje=f"Error al agendar cita: {e}",
+                mensaje="Ya existe una cita con esos datos.",
                 exito=False,
                 nueva_cita="true",
             )
         )
 
+    invalidar_citas(medico_id)
+    return redirect(
+        url_for(
+            "historial_paciente",
+            paciente_id=paciente_id,
+            mensaje="Cita agendada correctamente.",
+            exito=True,
+        )
+    )
+
 
 @app.route("/eliminar_paciente/<int:paciente_id>", methods=["POST"])
-@login_required
 def eliminar_paciente(paciente_id):
     """Elimina un paciente y todas sus citas después de la confirmación"""
-    medico_id = session["medico_id"]
+    medico_id = g.medico_id
 
     # Verificar confirmación
     confirmacion = request.form.get("confirmacion", "").strip().upper()
@@ -881,78 +1268,32 @@ def eliminar_paciente(paciente_id):
             url_for("eliminar_paciente_confirmacion", paciente_id=paciente_id)
         )
 
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
-        return redirect(
-            url_for(
-                "historial_paciente",
-                paciente_id=paciente_id,
-                mensaje=f"Error BD: {conn}",
-                exito=False,
-            )
-        )
-
     try:
-        cursor = conn.cursor()
-
-        # Verificar que el paciente pertenece al médico y obtener nombre
-        cursor.execute(
-            """
-            SELECT nombre FROM pacientes
-            WHERE id = %s AND medico_id = %s
-        """,
-            (paciente_id, medico_id),
-        )
-
-        paciente_data = cursor.fetchone()
-        if not paciente_data:
-            cursor.close()
-            conn.close()
-            return redirect(
-                url_for(
-                    "dashboard",
-                    mensaje="Paciente no encontrado o no autorizado.",
-                    exito=False,
+        with db_cursor() as cursor:
+            # Eliminar el paciente (sus citas se borran por ON DELETE CASCADE)
+            ejecutar_preparada(cursor, "eliminar_paciente", (paciente_id, medico_id))
+
+            paciente_data = cursor.fetchone()
+            if not paciente_data:
+                return redirect(
+                    url_for(
+                        "dashboard",
+                        mensaje="Paciente no encontrado o no autorizado.",
+                        exito=False,
+                    )
                 )
-            )
-
-        nombre_paciente = paciente_data[0]
-
-        # Eliminar todas las citas del paciente (por CASCADE también se eliminan)
-        cursor.execute(
-            """
-            DELETE FROM citas
-            WHERE paciente_id = %s AND medico_id = %s
-        """,
-            (paciente_id, medico_id),
-        )
-
-        # Eliminar el paciente
-        cursor.execute(
-            """
-            DELETE FROM pacientes
-            WHERE id = %s AND medico_id = %s
-        """,
-            (paciente_id, medico_id),
-        )
-
-        conn.commit()
-        cursor.close()
-        conn.close()
 
+            nombre_paciente = paciente_data[0]
+    except ErrorConexionBD as e:
         return redirect(
             url_for(
-                "dashboard",
-                mensaje=f"Paciente '{nombre_paciente}' eliminado correctamente junto con todas sus citas.",
-                exito=True,
+                "historial_paciente",
+                paciente_id=paciente_id,
+                mensaje=f"Error BD: {e}",
+                exito=False,
             )
         )
-
     except Exception as e:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
         return redirect(
             url_for(
                 "historial_paciente",
@@ -962,76 +1303,59 @@ def eliminar_paciente(paciente_id):
             )
         )
 
+    invalidar_citas(medico_id)
+    invalidar_pacientes(medico_id)
+    return redirect(
+        url_for(
+            "dashboard",
+            mensaje=(
+                f"Paciente '{nombre_paciente}' eliminado correctamente "
+                "junto con todas sus citas."
+            ),
+            exito=True,
+        )
+    )
+
 
 @app.route("/eliminar_paciente/confirmacion/<int:paciente_id>")
-@login_required
 def eliminar_paciente_confirmacion(paciente_id):
     """Muestra la página de confirmación para eliminar un paciente"""
-    medico_id = session["medico_id"]
-
-    conn = get_db_connection()
-    if not isinstance(conn, psycopg2.extensions.connection):
-        return redirect(url_for("dashboard", mensaje=f"Error BD: {conn}", exito=False))
+    medico_id = g.medico_id
 
     try:
-        cursor = conn.cursor()
-
-        # Verificar que el paciente pertenece al médico
-        cursor.execute(
-            """
-            SELECT id, nombre, edad, email, telefono, historial, fecha_registro
-            FROM pacientes
-            WHERE id = %s AND medico_id = %s
-        """,
-            (paciente_id, medico_id),
-        )
-
-        paciente_data = cursor.fetchone()
-        if not paciente_data:
-            cursor.close()
-            conn.close()
-            return redirect(
-                url_for(
-                    "dashboard",
-                    mensaje="Paciente no encontrado o no autorizado.",
-                    exito=False,
-                )
+        with db_cursor(psycopg2.extras.RealDictCursor) as cursor:
+            # Verificar que el paciente pertenece al médico y contar sus citas
+            # en la misma consulta
+            ejecutar_preparada(
+                cursor, "paciente_confirmacion", (paciente_id, medico_id)
             )
 
-        # Crear objeto paciente
-        paciente = {
-            "id": paciente_data[0],
-            "nombre": paciente_data[1],
-            "edad": paciente_data[2],
-            "email": paciente_data[3],
-            "telefono": paciente_data[4],
-            "historial": paciente_data[5],
-            "fecha_registro": paciente_data[6],
-        }
-
-        # Contar total de citas
-        cursor.execute(
-            """
-            SELECT COUNT(*) FROM citas
-            WHERE paciente_id = %s AND medico_id = %s
-        """,
-            (paciente_id, medico_id),
-        )
-
-        total_citas = cursor.fetchone()[0]
-
-        cursor.close()
-        conn.close()
+            paciente = cursor.fetchone()
+            if not paciente:
+                return redirect(
+                    url_for(
+                        "dashboard",
+                        mensaje="Paciente no encontrado o no autorizado.",
+                        exito=False,
+                    )
+                )
 
-        return render_template(
-            "confirmar_eliminacion.html", paciente=paciente, total_citas=total_citas
-        )
+        clave = hashlib.blake2b(
+            repr(sorted(paciente.items())).encode(), digest_size=16
+        ).digest()
+        pagina = _paginas_cache.get(clave)
+        if pagina is None:
+            pagina = render_template(
+                "confirmar_eliminacion.html",
+                paciente=paciente,
+                total_citas=paciente["total_citas"],
+            )
+            _paginas_cache.set(clave, pagina)
+        return pagina
 
+    except ErrorConexionBD as e:
+        return redirect(url_for("dashboard", mensaje=f"Error BD: {e}", exito=False))
     except Exception as e:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
         return redirect(
             url_for(
                 "dashboard", mensaje=f"Error al cargar confirmación: {e}", exito=False
@@ -1042,6 +1366,7 @@ def eliminar_paciente_confirmacion(paciente_id):
 @app.route("/logout")
 def logout():
     """Cerrar sesión"""
+    _medicos_cache.delete(g.medico_id)
     session.clear()
     return redirect(url_for("index"))
 
@@ -1050,5 +1375,10 @@ def logout():
 
 if __name__ == "__main__":
     # Ejecutar una sola vez, sin reloader para evitar dobles cargas y pérdida de estado
-    init_db()
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
+    ensure_schema()
+    app.run(
+        host="0.0.0.0",
+        port=5000,
+        debug=os.environ.get("FLASK_DEBUG") == "1",
+        use_reloader=False,
+    )
@@ -0,0 +1,30 @@
+# Configuración de gunicorn para producción
+# Uso: gunicorn -c gunicorn.conf.py wsgi:application
+
+import os
+
+# Parchear la librería estándar y psycopg2 antes de cargar la aplicación
+# (preload_app la importa en el proceso maestro) para que las esperas de red y
+# de Postgres cedan el control a otros greenlets en lugar de bloquear el worker
+from gevent import monkey
+
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+
+patch_psycopg()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+worker_class = "gevent"
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+preload_app = True
+
+
+def on_starting(server):
+    """Comprueba el esquema una sola vez en el proceso maestro, antes de los workers"""
+    from app import cerrar_db_pool, ensure_schema
+
+    ensure_schema()
+    # Los workers no deben heredar las conexiones abiertas por el maestro
+    cerrar_db_pool()
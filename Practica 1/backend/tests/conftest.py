@@ -0,0 +1,57 @@
+# backend/tests/conftest.py
+import pytest
+
+
+class FakeCursor:
+    """Cursor mínimo: guarda las consultas ejecutadas y devuelve resultados fijos."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []  # (sql, params) en orden de ejecución
+        self.fetchone_result = None
+        self.fetchone_results = []  # si no está vacía se consume en orden
+        self.fetchall_result = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+    def fetchone(self):
+        if self.fetchone_results:
+            return self.fetchone_results.pop(0)
+        return self.fetchone_result
+
+    def fetchall(self):
+        return self.fetchall_result
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    """Conexión falsa que comparte un único FakeCursor entre todas las consultas."""
+
+    def __init__(self):
+        self.fake_cursor = FakeCursor(self)
+        self.autocommit = True
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, cursor_factory=None):
+        return self.fake_cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_conn(monkeypatch):
+    """Sustituye get_db_connection por una conexión falsa compartida."""
+    conn = FakeConn()
+    monkeypatch.setattr("app.get_db_connection", lambda: conn)
+    return conn
@@ -3,25 +3,38 @@ import os
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import hashlib
 import pytest
-import psycopg2
-from unittest.mock import patch, MagicMock
-from app import app
+from datetime import date, time
+from unittest.mock import patch
+import flask
+from app import app, _medicos_cache, _citas_cache, _pacientes_cache, _paginas_cache
 
 
-@pytest.fixture
-def client():
-    """Crea un cliente de pruebas de Flask."""
+@pytest.fixture(scope="module")
+def cliente_modulo():
+    """Crea un único cliente de pruebas de Flask para todo el módulo."""
     with app.test_client() as client:
         yield client
 
 
+@pytest.fixture
+def client(cliente_modulo):
+    """Reutiliza el cliente del módulo sin sesión ni cachés de pruebas anteriores."""
+    _medicos_cache.clear()
+    _citas_cache.clear()
+    _pacientes_cache.clear()
+    _paginas_cache.clear()
+    cliente_modulo.delete_cookie(app.config["SESSION_COOKIE_NAME"])
+    yield cliente_modulo
+
+
 # ==========================================
 # TESTS BÁSICOS DE REGISTRO Y LOGIN
 # ==========================================
 
-def test_registro_medico_completo(client):
-    """Prueba el flujo completo de registro de médico."""
+def test_registro_y_login_medico(client):
+    """Prueba el flujo completo de registro y login de un médico."""
     nuevo_medico = {
         "nombre": "Dr. Ana María",
         "email": "anamaria@hospital.com",
@@ -31,20 +44,7 @@ def test_registro_medico_completo(client):
     response = client.post("/register", data=nuevo_medico)
     assert response.status_code in (200, 302)
 
-
-def test_login_medico(client):
-    """Prueba el login de un médico."""
-    # Primero registrar
-    nuevo_medico = {
-        "nombre": "Dr. Carlos Mario",
-        "email": "carlosmario@hospital.com",
-        "password": "password123",
-        "especialidad": "Pediatría",
-    }
-    client.post("/register", data=nuevo_medico)
-
-    # Luego hacer login
-    login_data = {"email": "carlosmario@hospital.com", "password": "password123"}
+    login_data = {"email": "anamaria@hospital.com", "password": "password123"}
     response = client.post("/login", data=login_data)
     assert response.status_code in (200, 302)
 
@@ -71,8 +71,7 @@ def test_api_citas_sin_login(client):
     assert response.status_code == 302
 
 
-@patch("app.get_db_connection")
-def test_agregar_paciente_sin_login(mock_get_conn, client):
+def test_agregar_paciente_sin_login(client):
     """Verifica que agregar paciente requiere autenticación."""
     response = client.post(
         "/agregar_paciente",
@@ -116,16 +115,101 @@ def test_eliminar_paciente_confirmacion_sin_login(client):
 # TESTS CON AUTENTICACIÓN
 # ==========================================
 
-@patch("app.get_db_connection")
-def test_dashboard_con_login(mock_get_conn, client):
+def test_dashboard_con_login(fake_conn, client):
     """Verifica acceso al dashboard con autenticación."""
-    mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.fetchone.return_value = (1, "Dr. Test")
-    mock_cursor.fetchall.return_value = []
-    mock_conn.__class__ = psycopg2.extensions.connection
-    mock_get_conn.return_value = mock_conn
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = []
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.get("/dashboard")
+    assert response.status_code == 200
+
+
+def test_dashboard_una_consulta_por_pacientes(fake_conn, client):
+    """Verifica que el dashboard no lanza una consulta de citas por paciente."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = [
+        {"id": 1, "nombre": "Amanda Aroutin", "edad": 21, "citas_count": 2},
+        {"id": 2, "nombre": "Eduardo Lukacs", "edad": 20, "citas_count": 0},
+    ]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.get("/dashboard")
+    assert response.status_code == 200
+    assert b"Eduardo Lukacs" in response.data
+    # Una consulta para verificar el médico y otra para los pacientes
+    assert len(cursor.executed) == 2
+
+
+def test_api_citas_usa_cache(fake_conn, client):
+    """Verifica que /api/citas se sirve desde caché hasta que cambian las citas."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = [("2024-10-15", "10:00:00", "Revisión", 7)]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    primera = client.get("/api/citas")
+    segunda = client.get("/api/citas")
+    assert primera.get_json() == segunda.get_json()
+    assert primera.get_json()[0]["id"] == 7
+    # Verificación del médico + una única consulta de citas
+    assert len(cursor.executed) == 2
+
+    client.post("/cancelar_cita/7")
+    client.get("/api/citas")
+    # Cancelar la cita invalida la caché: UPDATE + nueva consulta de citas
+    assert len(cursor.executed) == 4
+
+
+def test_api_citas_etag(fake_conn, client):
+    """Verifica que /api/citas responde 304 si el cliente ya tiene las citas."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = [("2024-10-15", "10:00:00", "Revisión", 7)]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    primera = client.get("/api/citas")
+    assert primera.status_code == 200
+    etag = primera.headers["ETag"]
+
+    segunda = client.get("/api/citas", headers={"If-None-Match": etag})
+    assert segunda.status_code == 304
+    assert segunda.data == b""
+
+
+def test_autenticacion_usa_cache_de_medicos(fake_conn, client):
+    """Verifica que el médico solo se consulta en BD en la primera petición."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = []
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    assert client.get("/dashboard").status_code == 200
+    assert client.get("/dashboard").status_code == 200
+    # Verificación del médico y consulta de pacientes una sola vez (en caché)
+    assert len(cursor.executed) == 2
+
+
+def test_peticion_autenticada_no_reescribe_cookie(fake_conn, client):
+    """Verifica que una petición autenticada no vuelve a emitir la cookie de sesión."""
+    fake_conn.fake_cursor.fetchone_result = (1, "Dr. Test")
 
     with client.session_transaction() as sess:
         sess["medico_id"] = 1
@@ -133,18 +217,60 @@ def test_dashboard_con_login(mock_get_conn, client):
 
     response = client.get("/dashboard")
     assert response.status_code == 200
+    assert "Set-Cookie" not in response.headers
+
+
+def test_dashboard_cache_pacientes_se_invalida(fake_conn, client):
+    """Verifica que la lista de pacientes se vuelve a consultar tras añadir uno."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = []
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    assert client.get("/dashboard").status_code == 200
+    assert _pacientes_cache.get((1, 0)) is not None
+    client.post(
+        "/agregar_paciente",
+        data={
+            "nombre": "Juan Pérez",
+            "edad": "35",
+            "email": "juan@test.com",
+            "fecha_registro": "2024-01-01",
+        },
+    )
+    assert _pacientes_cache.get((1, 0)) is None
+    with client.session_transaction() as sess:
+        assert sess["version_pacientes"] != 0
+
+
+def test_cache_no_sirve_datos_de_otro_worker(fake_conn, client):
+    """Verifica que tras escribir no se usa la entrada que guarda otro worker."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = [("2024-10-15", "10:00:00", "Revisión", 7)]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    client.post("/cancelar_cita/7")
+    # Otro worker todavía tiene las citas anteriores a la cancelación
+    _citas_cache.set((1, 0), (b"[]", "antigua"))
+    ejecutadas = len(cursor.executed)
+
+    response = client.get("/api/citas")
+    assert response.get_json()[0]["id"] == 7
+    assert len(cursor.executed) == ejecutadas + 1
 
 
-@patch("app.get_db_connection")
-def test_api_citas_con_login(mock_get_conn, client):
+def test_api_citas_con_login(fake_conn, client):
     """Verifica acceso a API de citas con autenticación."""
-    mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.fetchone.return_value = (1, "Dr. Test")
-    mock_cursor.fetchall.return_value = []
-    mock_conn.__class__ = psycopg2.extensions.connection
-    mock_get_conn.return_value = mock_conn
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = []
 
     with client.session_transaction() as sess:
         sess["medico_id"] = 1
@@ -155,6 +281,29 @@ def test_api_citas_con_login(mock_get_conn, client):
     assert response.content_type == "application/json"
 
 
+def test_api_citas_formato_fechas(fake_conn, client):
+    """Verifica que fechas y horas de las citas se devuelven en formato ISO."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    cursor.fetchall_result = [
+        (date(2024, 10, 15), time(10, 30), "Consulta general", 1)
+    ]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.get("/api/citas")
+    assert response.get_json() == [
+        {
+            "fecha": "2024-10-15",
+            "hora": "10:30:00",
+            "motivo": "Consulta general",
+            "id": 1,
+        }
+    ]
+
+
 # ==========================================
 # TESTS DE VALIDACIÓN DE FORMULARIOS
 # ==========================================
@@ -175,32 +324,83 @@ def test_register_campos_vacios(client):
     assert b"completa todos los campos" in response.data.lower()
 
 
-def test_login_credenciales_incorrectas(client):
+def test_login_credenciales_incorrectas(fake_conn, client):
     """Verifica manejo de credenciales incorrectas."""
-    with patch("app.get_db_connection") as mock_get_conn:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = None
-        mock_conn.__class__ = psycopg2.extensions.connection
-        mock_get_conn.return_value = mock_conn
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = None
+
+    response = client.post(
+        "/login", data={"email": "noexiste@example.com", "password": "password123"}
+    )
+    assert response.status_code == 200
+    assert b"credenciales incorrectas" in response.data.lower()
 
+
+def test_login_email_inexistente_calcula_scrypt(fake_conn, client):
+    """Verifica que un email no registrado también pasa por scrypt."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = None
+
+    with patch("app.hashlib.scrypt", wraps=hashlib.scrypt) as scrypt:
         response = client.post(
-            "/login", data={"email": "noexiste@example.com", "password": "password123"}
+            "/login", data={"email": "noexiste@example.com", "password": "x"}
         )
-        assert response.status_code == 200
-        assert b"credenciales incorrectas" in response.data.lower()
+    assert b"credenciales incorrectas" in response.data.lower()
+    scrypt.assert_called_once()
+
+
+def test_login_migra_hash_sha256(fake_conn, client):
+    """Verifica que un hash SHA-256 antiguo se sustituye por scrypt al entrar."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (
+        1,
+        "Dr. Test",
+        "test@example.com",
+        hashlib.sha256(b"password123").hexdigest(),
+    )
+
+    response = client.post(
+        "/login", data={"email": "test@example.com", "password": "password123"}
+    )
+    assert response.status_code == 302
+
+    sql, params = cursor.executed[-1]
+    assert "UPDATE medicos SET password_hash" in sql
+    assert params[0].startswith("scrypt$")
+    assert params[1] == 1
+
+
+def test_login_verifica_hash_scrypt(fake_conn, client):
+    """Verifica que el login compara la contraseña con el hash guardado."""
+    from app import hash_password
+
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (
+        1,
+        "Dr. Test",
+        "test@example.com",
+        hash_password("password123"),
+    )
+
+    response = client.post(
+        "/login", data={"email": "test@example.com", "password": "incorrecta"}
+    )
+    assert b"credenciales incorrectas" in response.data.lower()
+
+    response = client.post(
+        "/login", data={"email": "test@example.com", "password": "password123"}
+    )
+    assert response.status_code == 302
+    # Al entrar se usan versiones nuevas de las cachés, no las de otra sesión
+    with client.session_transaction() as sess:
+        assert sess["version_pacientes"] != 0
+        assert sess["version_citas"] != 0
 
 
-@patch("app.get_db_connection")
-def test_register_email_duplicado(mock_get_conn, client):
+def test_register_email_duplicado(fake_conn, client):
     """Verifica manejo de email ya registrado."""
-    mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.fetchone.return_value = (1,)
-    mock_conn.__class__ = psycopg2.extensions.connection
-    mock_get_conn.return_value = mock_conn
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = None  # ON CONFLICT no devuelve id
 
     response = client.post(
         "/register",
@@ -213,3 +413,247 @@ def test_register_email_duplicado(mock_get_conn, client):
     )
     assert response.status_code == 200
     assert b"email ya est" in response.data.lower()
+
+
+def test_agregar_cita_duplicada(fake_conn, client):
+    """Verifica que una cita duplicada se detecta con una sola consulta."""
+    cursor = fake_conn.fake_cursor
+    # Verificación del médico y después (paciente_existe, id_cita_nueva)
+    cursor.fetchone_results = [(1, "Dr. Test"), (True, None)]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.post(
+        "/historial/1/agregar_cita",
+        data={"fecha": "2024-10-15", "hora": "10:00", "motivo": "Consulta"},
+    )
+    assert response.status_code == 302
+    assert "Ya+existe+una+cita" in response.headers["Location"]
+    assert len(cursor.executed) == 2
+
+
+def test_eliminar_paciente_una_sentencia(fake_conn, client):
+    """Verifica que el paciente se elimina con un único DELETE ... RETURNING."""
+    cursor = fake_conn.fake_cursor
+    # Verificación del médico y después el nombre devuelto por el DELETE
+    cursor.fetchone_results = [(1, "Dr. Test"), ("Amanda Aroutin",)]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.post("/eliminar_paciente/1", data={"confirmacion": "eliminar"})
+    assert response.status_code == 302
+    assert "Amanda+Aroutin" in response.headers["Location"]
+    assert len(cursor.executed) == 2
+    assert "RETURNING nombre" in cursor.executed[-1][0]
+
+
+def test_historial_paciente_con_login(fake_conn, client):
+    """Verifica que el historial se renderiza con filas tipo diccionario."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    paciente = {
+        "id": 1,
+        "nombre": "Amanda Aroutin",
+        "edad": 21,
+        "email": "amanda@test.com",
+        "telefono": None,
+        "historial": None,
+        "fecha_registro": None,
+    }
+    cursor.fetchall_result = [
+        {
+            **paciente,
+            "cita_id": 10,
+            "medico_id": 1,
+            "fecha": date(2024, 10, 15),
+            "hora": time(10, 0),
+            "motivo": "Revisión anual",
+            "cancelada": False,
+            "citas_activas": 1,
+            "citas_canceladas": 1,
+        },
+        {
+            **paciente,
+            "cita_id": 11,
+            "medico_id": 1,
+            "fecha": date(2024, 9, 1),
+            "hora": time(9, 0),
+            "motivo": "Consulta",
+            "cancelada": True,
+            "citas_activas": 1,
+            "citas_canceladas": 1,
+        },
+    ]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.get("/historial/1")
+    assert response.status_code == 200
+    assert b"Revisi\xc3\xb3n anual" in response.data
+    assert b"/cancelar_cita/10" in response.data
+    assert b"/cancelar_cita/11" not in response.data
+    # Verificación del médico + una única consulta para paciente y citas
+    assert len(cursor.executed) == 2
+
+
+def test_eliminar_paciente_confirmacion_con_login(fake_conn, client):
+    """Verifica que la confirmación obtiene paciente y total de citas a la vez."""
+    cursor = fake_conn.fake_cursor
+    paciente = {
+        "id": 1,
+        "nombre": "Amanda Aroutin",
+        "edad": 21,
+        "email": "amanda@test.com",
+        "telefono": None,
+        "historial": None,
+        "fecha_registro": None,
+        "total_citas": 3,
+    }
+    cursor.fetchone_results = [(1, "Dr. Test"), paciente]
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    with patch("app.render_template", wraps=flask.render_template) as render:
+        response = client.get("/eliminar_paciente/confirmacion/1")
+        assert response.status_code == 200
+        assert b"3 citas" in response.data
+        assert len(cursor.executed) == 2
+
+        # Con los mismos datos la página sale de la caché sin volver a renderizar
+        cursor.fetchone_results = [paciente]
+        segunda = client.get("/eliminar_paciente/confirmacion/1")
+        assert segunda.data == response.data
+        render.assert_called_once()
+
+
+@patch("app.insertar_pacientes")
+def test_agregar_pacientes_json(mock_insertar, fake_conn, client):
+    """Verifica que una lista JSON de pacientes se inserta de una sola vez."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    mock_insertar.return_value = ([7, 8], None)
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    response = client.post(
+        "/agregar_paciente",
+        json=[
+            {
+                "nombre": "Juan Pérez",
+                "edad": "35",
+                "email": "juan@test.com",
+                "fecha_registro": "2024-01-01",
+            },
+            {
+                "nombre": "María López",
+                "edad": 42,
+                "email": "maria@test.com",
+                "telefono": "555-5678",
+                "fecha_registro": "2024-01-02",
+            },
+        ],
+    )
+    assert response.status_code == 201
+    assert response.get_json() == {"ids": [7, 8]}
+    medico_id, pacientes = mock_insertar.call_args[0]
+    assert medico_id == 1
+    assert pacientes[0] == ("Juan Pérez", 35, "juan@test.com", None, "2024-01-01", None)
+
+    response = client.post("/agregar_paciente", json=[{"nombre": "Sin datos"}])
+    assert response.status_code == 400
+
+
+@patch("app.insertar_pacientes")
+def test_agregar_pacientes_json_edad_cero(mock_insertar, fake_conn, client):
+    """Verifica que edad 0 es válida y que un campo vacío se rechaza."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+    mock_insertar.return_value = ([9], None)
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    paciente = {
+        "nombre": "Recién nacido",
+        "edad": 0,
+        "email": "bebe@test.com",
+        "fecha_registro": "2024-01-01",
+    }
+    response = client.post("/agregar_paciente", json=paciente)
+    assert response.status_code == 201
+    assert mock_insertar.call_args[0][1][0][1] == 0
+
+    response = client.post("/agregar_paciente", json={**paciente, "email": ""})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "cambios",
+    [
+        {"nombre": {"a": 1}},
+        {"email": ["x@test.com"]},
+        {"telefono": 5551234},
+        {"historial": {"texto": "..."}},
+        {"fecha_registro": "2024-13-45"},
+        {"edad": True},
+        {"edad": 3.7},
+        {"edad": "3.7"},
+    ],
+)
+@patch("app.insertar_pacientes")
+def test_agregar_pacientes_json_tipos_invalidos(
+    mock_insertar, fake_conn, client, cambios
+):
+    """Verifica que los tipos incorrectos se rechazan con 400 sin llegar a la BD."""
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    paciente = {
+        "nombre": "Juan Pérez",
+        "edad": 35,
+        "email": "juan@test.com",
+        "fecha_registro": "2024-01-01",
+    }
+    response = client.post("/agregar_paciente", json={**paciente, **cambios})
+    assert response.status_code == 400
+    mock_insertar.assert_not_called()
+
+
+@patch("app.insertar_pacientes")
+def test_agregar_pacientes_json_limite(mock_insertar, fake_conn, client):
+    """Verifica que se rechazan las listas con demasiados pacientes."""
+    from app import MAX_PACIENTES_JSON
+
+    cursor = fake_conn.fake_cursor
+    cursor.fetchone_result = (1, "Dr. Test")
+
+    with client.session_transaction() as sess:
+        sess["medico_id"] = 1
+        sess["medico_nombre"] = "Dr. Test"
+
+    paciente = {
+        "nombre": "Juan Pérez",
+        "edad": 35,
+        "email": "juan@test.com",
+        "fecha_registro": "2024-01-01",
+    }
+    response = client.post(
+        "/agregar_paciente", json=[paciente] * (MAX_PACIENTES_JSON + 1)
+    )
+    assert response.status_code == 400
+    mock_insertar.assert_not_called()
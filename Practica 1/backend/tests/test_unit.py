@@ -4,18 +4,25 @@ import os
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import hashlib
 import psycopg2
+import pytest
 from unittest.mock import patch, MagicMock
 from app import (
     app,
     hash_password,
-    get_next_medico_id,
+    verificar_password,
     get_db_connection,
+    PoolConEspera,
     init_db,
+    ensure_schema,
     obtener_citas_medico,
     obtener_pacientes_medico,
+    insertar_pacientes,
     buscar_paciente_por_id,
     get_db_host,
+    preparar_sentencias,
+    ejecutar_preparada,
 )
 
 
@@ -43,15 +50,21 @@ def test_hash_password():
     password = "test123"
     hashed = hash_password(password)
     assert hashed is not None
-    assert len(hashed) == 64  # SHA256 produce 64 caracteres
+    assert hashed.startswith("scrypt$")
+    assert len(hashed.split("$")[-1]) == 64  # scrypt con dklen=32 en hexadecimal
     assert hashed != password  # El hash debe ser diferente al password original
+    assert hashed != hash_password(password)  # Cada hash usa una sal distinta
 
 
-def test_get_next_medico_id():
-    """Verifica que la función get_next_medico_id retorna un número válido."""
-    next_id = get_next_medico_id()
-    assert isinstance(next_id, int)
-    assert next_id >= 1
+def test_verificar_password():
+    """Verifica la comprobación de contraseñas scrypt y SHA-256 antiguas."""
+    hashed = hash_password("test123")
+    assert verificar_password("test123", hashed)
+    assert not verificar_password("otra", hashed)
+
+    legacy = hashlib.sha256(b"test123").hexdigest()
+    assert verificar_password("test123", legacy)
+    assert not verificar_password("otra", legacy)
 
 
 def test_get_db_host():
@@ -59,30 +72,100 @@ def test_get_db_host():
     host = get_db_host()
     assert host is not None
     assert isinstance(host, str)
-    assert host in ["bd", "localhost"]
+    assert host in ["bd", "localhost", "/var/run/postgresql"]
+
+
+def test_get_db_host_socket_unix():
+    """Verifica que se usa el socket UNIX local cuando existe."""
+    get_db_host.cache_clear()
+    try:
+        with patch.dict(os.environ, {}, clear=False), patch(
+            "app.os.path.exists", return_value=True
+        ), patch("app.socket.create_connection") as mock_create:
+            os.environ.pop("DB_HOST", None)
+            os.environ.pop("DB_SOCKET_DIR", None)
+            assert get_db_host() == "/var/run/postgresql"
+            mock_create.assert_not_called()
+    finally:
+        get_db_host.cache_clear()
+
+
+def test_get_db_host_explicito():
+    """Verifica que DB_HOST se usa sin sondear y que el resultado se memoiza."""
+    get_db_host.cache_clear()
+    try:
+        with patch.dict(os.environ, {"DB_HOST": "db.interno"}), patch(
+            "app.socket.create_connection"
+        ) as mock_create:
+            assert get_db_host() == "db.interno"
+            assert get_db_host() == "db.interno"
+            mock_create.assert_not_called()
+    finally:
+        get_db_host.cache_clear()
 
 
 # ==========================================
 # TESTS DE CONEXIÓN A BASE DE DATOS
 # ==========================================
 
-@patch("app.psycopg2.connect")
-def test_get_db_connection_success(mock_connect):
-    """Verifica conexión exitosa a la base de datos."""
+@patch("app.get_db_pool")
+def test_get_db_connection_success(mock_get_pool):
+    """Verifica que la conexión se obtiene del pool."""
     mock_conn = MagicMock()
-    mock_connect.return_value = mock_conn
+    mock_get_pool.return_value.getconn.return_value = mock_conn
 
     conn = get_db_connection()
 
     assert conn == mock_conn
-    mock_connect.assert_called_once()
-    mock_conn.set_session.assert_called_once()
-
-
-@patch("app.psycopg2.connect")
-def test_get_db_connection_failure(mock_connect):
+    mock_get_pool.return_value.getconn.assert_called_once()
+    assert mock_conn.autocommit is True
+
+
+@patch("app.psycopg2.pool.ThreadedConnectionPool.putconn")
+@patch("app.psycopg2.pool.ThreadedConnectionPool.getconn")
+@patch("app.psycopg2.pool.ThreadedConnectionPool.__init__", return_value=None)
+def test_pool_con_espera(mock_init, mock_getconn, mock_putconn):
+    """Verifica que el pool espera por una conexión libre y la libera al devolverla."""
+    mock_getconn.return_value = MagicMock()
+    with patch("app.DB_POOL_TIMEOUT", 0.01):
+        pool = PoolConEspera(1, 1)
+        conn = pool.getconn()
+        # Con todas las conexiones en uso, la siguiente petición agota la espera
+        with pytest.raises(psycopg2.pool.PoolError):
+            pool.getconn()
+        pool.putconn(conn)
+        assert pool.getconn() is mock_getconn.return_value
+    assert mock_getconn.call_count == 2
+    mock_putconn.assert_called_once()
+
+
+def test_pool_reutiliza_conexiones():
+    """Verifica que se guardan más de minconn conexiones libres para reutilizarlas."""
+
+    def conectar(*args, **kwargs):
+        conn = MagicMock(closed=False)
+        conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return conn
+
+    with patch("psycopg2.pool.psycopg2.connect", side_effect=conectar) as connect:
+        pool = PoolConEspera(2, 10)
+        for _ in range(3):
+            conexiones = [pool.getconn() for _ in range(10)]
+            for conn in conexiones:
+                pool.putconn(conn)
+
+    assert connect.call_count == 10
+    assert len(pool._pool) == 10
+    for conn in pool._pool:
+        conn.close.assert_not_called()
+
+
+@patch("app.get_db_pool")
+def test_get_db_connection_failure(mock_get_pool):
     """Verifica manejo de error en conexión a BD."""
-    mock_connect.side_effect = psycopg2.Error("Connection failed")
+    mock_get_pool.return_value.getconn.side_effect = psycopg2.pool.PoolError(
+        "Connection failed"
+    )
 
     result = get_db_connection()
 
@@ -90,23 +173,76 @@ def test_get_db_connection_failure(mock_connect):
     assert "Connection failed" in result
 
 
+def test_preparar_sentencias():
+    """Verifica que se preparan las consultas frecuentes con parámetros $n."""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value = mock_cursor
+
+    preparar_sentencias(mock_conn)
+
+    sql = mock_cursor.execute.call_args[0][0]
+    assert sql.startswith("DEALLOCATE ALL;")
+    assert "PREPARE medico_por_id AS" in sql
+    assert "WHERE id = $1" in sql
+    assert "PREPARE citas_medico AS" in sql
+    assert "PREPARE historial_paciente AS" in sql
+    assert "WHERE p.id = $1 AND p.medico_id = $2" in sql
+    assert mock_conn.sentencias_preparadas is True
+
+
+def test_ejecutar_preparada():
+    """Verifica que se usa EXECUTE solo si la conexión tiene las consultas."""
+    mock_cursor = MagicMock()
+    mock_cursor.connection.sentencias_preparadas = True
+    ejecutar_preparada(mock_cursor, "medico_login", ("a@b.com",))
+    mock_cursor.execute.assert_called_once_with(
+        "EXECUTE medico_login (%s)", ("a@b.com",)
+    )
+
+    mock_cursor = MagicMock()
+    mock_cursor.connection.sentencias_preparadas = False
+    ejecutar_preparada(mock_cursor, "medico_por_id", (1,))
+    assert "SELECT id, nombre FROM medicos" in mock_cursor.execute.call_args[0][0]
+
+
 @patch("app.get_db_connection")
 def test_init_db_success(mock_get_conn):
     """Verifica inicialización exitosa de la base de datos."""
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
     mock_conn.cursor.return_value = mock_cursor
-    mock_conn.__class__ = psycopg2.extensions.connection
     mock_get_conn.return_value = mock_conn
 
     init_db()
 
-    assert mock_cursor.execute.call_count == 3  # 3 tablas
+    mock_cursor.execute.assert_called_once()  # tablas e índices en un solo viaje
     mock_conn.commit.assert_called_once()
     mock_cursor.close.assert_called_once()
     mock_conn.close.assert_called_once()
 
 
+@patch("app.init_db")
+@patch("app.get_db_connection")
+def test_ensure_schema(mock_get_conn, mock_init_db):
+    """Verifica que las tablas solo se crean si no existen."""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value = mock_cursor
+    mock_get_conn.return_value = mock_conn
+
+    mock_cursor.fetchone.return_value = (True,)
+    ensure_schema()
+    mock_init_db.assert_not_called()
+
+    mock_cursor.fetchone.return_value = (False,)
+    ensure_schema()
+    mock_init_db.assert_called_once()
+    sql = mock_cursor.execute.call_args[0][0]
+    assert "to_regclass('public.citas')" in sql
+    assert "to_regclass('public.citas_unique_slot')" in sql
+
+
 # ==========================================
 # TESTS DE OPERACIONES CON CITAS
 # ==========================================
@@ -117,7 +253,6 @@ def test_obtener_citas_medico_success(mock_get_conn):
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
     mock_conn.cursor.return_value = mock_cursor
-    mock_conn.__class__ = psycopg2.extensions.connection
     mock_get_conn.return_value = mock_conn
 
     citas_mock = [
@@ -168,6 +303,7 @@ def test_obtener_pacientes_medico_success(mock_get_conn):
             "123456789",
             "Historial 1",
             "2024-01-01",
+            3,
         ),
         (
             2,
@@ -177,6 +313,7 @@ def test_obtener_pacientes_medico_success(mock_get_conn):
             "987654321",
             "Historial 2",
             "2024-01-02",
+            0,
         ),
     ]
     mock_cursor.fetchall.return_value = pacientes_mock
@@ -200,6 +337,49 @@ def test_obtener_pacientes_medico_error(mock_get_conn):
     assert "Error de conexión" in error
 
 
+@patch("app.psycopg2.extras.execute_values")
+@patch("app.get_db_connection")
+def test_insertar_pacientes(mock_get_conn, mock_execute_values):
+    """Verifica que varios pacientes se insertan con una sola sentencia."""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value = mock_cursor
+    mock_get_conn.return_value = mock_conn
+    mock_execute_values.return_value = [(7,), (8,)]
+
+    pacientes = [
+        ("Juan Pérez", 35, "juan@test.com", "555-1234", "2024-01-01", None),
+        ("María López", 42, "maria@test.com", "555-5678", "2024-01-02", None),
+    ]
+    ids, error = insertar_pacientes(1, pacientes)
+
+    assert error is None
+    assert ids == [7, 8]
+    mock_execute_values.assert_called_once()
+    filas = mock_execute_values.call_args[0][2]
+    assert filas[0] == (1, *pacientes[0])
+    assert mock_conn.autocommit is False
+    mock_conn.commit.assert_called_once()
+
+
+@patch("app.psycopg2.extras.execute_values")
+@patch("app.get_db_connection")
+def test_insertar_pacientes_error_hace_rollback(mock_get_conn, mock_execute_values):
+    """Verifica que si falla una página no se confirma ningún paciente."""
+    mock_conn = MagicMock()
+    mock_get_conn.return_value = mock_conn
+    mock_execute_values.side_effect = psycopg2.Error("fallo en la página 2")
+
+    paciente = ("Juan Pérez", 35, "juan@test.com", None, "2024-01-01", None)
+    ids, error = insertar_pacientes(1, [paciente])
+
+    assert ids == []
+    assert "fallo" in error
+    assert mock_conn.autocommit is False
+    mock_conn.commit.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+
+
 @patch("app.get_db_connection")
 def test_buscar_paciente_por_id_success(mock_get_conn):
     """Verifica búsqueda exitosa de paciente por ID."""
@@ -216,6 +396,7 @@ def test_buscar_paciente_por_id_success(mock_get_conn):
         "123456789",
         "Historial",
         "2024-01-01",
+        2,
     )
     mock_cursor.fetchone.return_value = paciente_mock
 
@@ -0,0 +1,8 @@
+# Punto de entrada WSGI para producción
+# Uso: gunicorn -c gunicorn.conf.py wsgi:application
+# (o sin configuración: gunicorn -k gevent -w 4 --worker-connections 1000
+#  -b 0.0.0.0:5000 wsgi:application)
+
+from app import app
+
+application = app
@@ -28,3 +28,7 @@ CREATE TABLE IF NOT EXISTS citas (
     cancelada BOOLEAN DEFAULT FALSE
 );
 
+CREATE INDEX IF NOT EXISTS pacientes_medico_idx ON pacientes(medico_id);
+CREATE INDEX IF NOT EXISTS citas_medico_paciente_idx ON citas(medico_id, paciente_id);
+CREATE INDEX IF NOT EXISTS citas_medico_fecha_hora_idx ON citas(medico_id, fecha, hora);
+CREATE UNIQUE INDEX IF NOT EXISTS citas_unique_slot ON citas(medico_id, paciente_id, fecha, hora, motivo);